@@ -8,13 +8,14 @@ from io import BytesIO
 import win32clipboard
 from PIL import Image
 import sys
-from PySide6.QtCore import Qt, QSize
+from concurrent.futures import ProcessPoolExecutor
+from PySide6.QtCore import Qt, QSize, QThread, Signal
 from PySide6.QtWidgets import (QApplication, QMainWindow, QFileDialog, QPushButton, QWidget,
-                               QMessageBox, QLabel, QGridLayout, QVBoxLayout, QMenu, QInputDialog,
+                               QMessageBox, QLabel, QVBoxLayout, QMenu, QInputDialog,
                                QDialog, QScrollArea, QLineEdit, QCompleter, QTabWidget, QHBoxLayout,
                                QFrame)
-from PySide6.QtGui import QPixmap, QAction, QContextMenuEvent, QMovie
-from PicSearch import sql
+from PySide6.QtGui import QPixmap, QAction, QContextMenuEvent, QMovie, QColor
+from PicSearch import sql, metadata, color_index
 from flow_layout import FlowLayout
 import send2trash
 
@@ -75,6 +76,20 @@ class MainWindow(QMainWindow):
 
         self.check_dir()
 
+        sql.create_image_tags_index()
+        sql.create_metadata_columns()
+        if color_index.index_size() != sql.count_color_signatures():
+            self.rebuild_color_index()
+        self.metadata_worker = MetadataWorker(sql.get_images_without_metadata() or [])
+        self.metadata_worker.extracted.connect(sql.update_images_metadata)
+        self.metadata_worker.finished.connect(self.rebuild_color_index)
+        self.metadata_worker.start()
+
+    def closeEvent(self, event):
+        self.metadata_worker.stop()
+        self.metadata_worker.wait()
+        super().closeEvent(event)
+
     def make_dir(self):
         """
         Метод для создания в файловой системе директории с названием 'PicSearch',
@@ -148,6 +163,12 @@ class MainWindow(QMainWindow):
             new_path = directory / name
             Path(filename).rename(new_path)
             sql.add_image_to_db(new_path)
+            image_metadata = metadata.extract_metadata(new_path)
+            sql.update_images_metadata([(new_path, image_metadata)])
+            if image_metadata:
+                color_index.append_to_index(
+                    sql.get_image_id(new_path)[0],
+                    color_index.from_bytes(image_metadata['color_signature']))
             grid.load_files(directory, tab_index)
         except Exception as e:
             QMessageBox.critical(self, "Ошибка!", f"Ошибка при добавлении файла: {e}")
@@ -216,46 +237,192 @@ class MainWindow(QMainWindow):
             except Exception as e:
                 print(f"Произошла ошибка: {e}")
 
+    def add_tag_to_selected(self, files):
+        """
+        Метод для добавления тега сразу к нескольким выделенным изображениям.
+        Вызывает соответствующий метод из модуля sql.
+        :param files: Пути к выделенным изображениям.
+        """
+        tag, ok = QInputDialog.getText(self, "Добавление тега",
+                                       f"Введите тег, который хотите добавить к "
+                                       f"выбранным изображениям ({len(files)}):")
+        if ok and tag:
+            try:
+                image_ids = sql.get_image_ids(files)
+                sql.connect_tag_to_images(image_ids, tag)
+                self.update_completer()
+            except Exception as e:
+                print(f"Произошла ошибка: {e}")
+
+    def delete_tag_from_selected(self, files):
+        """
+        Метод для удаления тега сразу у нескольких выделенных изображений.
+        Вызывает соответствующий метод из модуля sql.
+        :param files: Пути к выделенным изображениям.
+        """
+        tag, ok = QInputDialog.getText(self, "Удаление тега",
+                                       f"Введите тег, который хотите удалить у "
+                                       f"выбранных изображений ({len(files)}):")
+        if ok and tag:
+            try:
+                if sql.get_tag_id(tag):
+                    image_ids = sql.get_image_ids(files)
+                    sql.disconnect_tag_from_images(image_ids, tag)
+                else:
+                    QMessageBox.warning(self, "Ошибка!", "Такого тега не существует.")
+            except Exception as e:
+                print(f"Произошла ошибка: {e}")
+
+    def rename_tag(self):
+        """
+        Метод для переименования тега. Если тег с новым названием уже существует,
+        теги объединяются. Вызывает соответствующий метод из модуля sql.
+        """
+        old_tag, ok = QInputDialog.getItem(self, "Редактирование тега",
+                                           "Выберите тег, который хотите изменить:",
+                                           sql.get_tags(), 0, False)
+        if not (ok and old_tag):
+            return
+
+        new_tag, ok = QInputDialog.getText(self, "Редактирование тега",
+                                           "Введите новое название тега:", text=old_tag)
+        if ok and new_tag and new_tag != old_tag:
+            try:
+                if sql.rename_tag(old_tag, new_tag):
+                    self.update_completer()
+                else:
+                    QMessageBox.warning(self, "Ошибка!", "Не удалось изменить тег.")
+            except Exception as e:
+                print(f"Произошла ошибка: {e}")
+
+    @staticmethod
+    def rebuild_color_index():
+        """
+        Перестраивает индекс цветов по сигнатурам из базы данных. При ошибке
+        прежний индекс остаётся без изменений.
+        """
+        try:
+            color_index.rebuild_index(sql.get_color_signatures())
+        except Exception as e:
+            print(f"Произошла ошибка: {e}")
+
+    def search_colors(self, signature, candidates):
+        """
+        Ищет изображения по цветовой сигнатуре. Если индекс повреждён, он перестраивается.
+        :param signature: Сигнатура, с которой сравниваются изображения.
+        :param candidates: Айди изображений, среди которых ведётся поиск.
+        :return: Список айди изображений, отсортированный по близости цветов.
+        """
+        try:
+            return color_index.search(signature, candidates=candidates)
+        except ValueError:
+            self.rebuild_color_index()
+        try:
+            return color_index.search(signature, candidates=candidates)
+        except ValueError as e:
+            print(f"Произошла ошибка: {e}")
+            return []
+
+    def show_similar_colors(self, file):
+        """
+        Показывает изображения, похожие по цвету на выбранное.
+        :param file: Путь к изображению.
+        """
+        signature = sql.get_color_signature(file)
+        if signature is None:
+            QMessageBox.warning(self, "Ошибка!", "Цвета этого изображения ещё не обработаны.")
+            return
+
+        current_index = self.tab_widget.currentIndex()
+        grid = self.image_grid if current_index == 0 else self.gif_grid
+        grid.clear()
+
+        candidates = sql.search_image_ids([], self.media_extensions(current_index)) or []
+        image_ids = self.search_colors(color_index.from_bytes(signature), candidates)
+        for image_path in sql.get_images_by_ids(image_ids) or []:
+            grid.layout.addWidget(grid.make_label(Path(image_path[0])))
+
+    @staticmethod
+    def media_extensions(tab_index):
+        """
+        Возвращает расширения файлов, которые отображаются на вкладке.
+        :param tab_index: Индекс вкладки: 0 — изображения, 1 — анимации.
+        :return: Список расширений.
+        """
+        return ['.png', '.jpg', '.jpeg'] if tab_index == 0 else ['.gif']
+
+    def update_completer(self):
+        """
+        Обновляет список подсказок в строке поиска.
+        """
+        self.completer.model().setStringList(sql.get_tags())
+
     def show_searched(self):
         """
         Обновляет отображение в зависимости от текста в строке поиска и текущей вкладки.
         """
-        text = self.searchbar.text()
+        filters, text = metadata.parse_query(self.searchbar.text())
+        colors = [QColor(name) for key, _, value in filters if key == 'color'
+                  for name in value.split(',')]
+        filters = [f for f in filters if f[0] != 'color']
         current_index = self.tab_widget.currentIndex()
 
         grid = self.image_grid if current_index == 0 else self.gif_grid
         folder = self.get_dir()
 
-        for i in reversed(range(grid.layout.count())):
-            widget = grid.layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
+        grid.clear()
 
-        if text == "":
+        if text == "" and not filters and not colors:
             grid.load_files(folder, current_index)
             return
 
-        images = sql.get_images()
+        # Фильтры по вкладке, метаданным и тегам применяются в базе данных,
+        # а при поиске по цвету — до ранжирования по цвету.
+        image_ids = sql.search_image_ids(filters, self.media_extensions(current_index), text) or []
+        if colors:
+            palette = [color.getRgb()[:3] for color in colors if color.isValid()]
+            if not palette:
+                return
+            image_ids = self.search_colors(color_index.palette_signature(palette), image_ids)
 
-        row, col = 0, 0
-        for image_path in images:
-            image_path = Path(image_path[0])
-            if current_index == 0 and image_path.suffix.lower() not in ['.png', '.jpg', '.jpeg']:
-                continue
-            if current_index == 1 and image_path.suffix.lower() != '.gif':
-                continue
+        for image_path in sql.get_images_by_ids(image_ids) or []:
+            grid.layout.addWidget(grid.make_label(Path(image_path[0])))
 
-            image_id = sql.get_image_id(file=image_path)
-            tags = sql.get_tags_for_image(image_id=image_id)
 
-            if any(text.lower().strip() in tag.lower().strip() for tag in tags):
-                label = MediaLabel(parent=self, file=image_path)
-                grid.layout.addWidget(label, row, col)
+class MetadataWorker(QThread):
+    """
+    Поток для извлечения метаданных изображений, добавленных до появления метаданных
+    в базе данных. Файлы обрабатываются в пуле процессов, а результат порциями передаётся
+    в основной поток сигналом extracted для сохранения в базу данных.
+    """
+    extracted = Signal(list)
 
-                col += 1
-                if col >= 4:
-                    col = 0
-                    row += 1
+    def __init__(self, image_paths):
+        super().__init__()
+        self.image_paths = image_paths
+        self.executor = None
+        self.stopped = False
+
+    def run(self):
+        if not self.image_paths or self.stopped:
+            return
+
+        self.executor = ProcessPoolExecutor()
+        try:
+            for batch in metadata.extract_batches(self.image_paths, self.executor):
+                if self.stopped:
+                    break
+                self.extracted.emit(batch)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """
+        Останавливает обработку: задачи, которые ещё не начали выполняться, отменяются.
+        """
+        self.stopped = True
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
 
 
 class Grid(QWidget):
@@ -263,8 +430,9 @@ class Grid(QWidget):
     def __init__(self, parent=None):
         super().__init__()
         self.setParent(parent)
-        self.layout = QGridLayout(self)
+        self.layout = FlowLayout(self, margin=9, spacing=6)
         self.setLayout(self.layout)
+        self.selected = set()
 
     def load_files(self, folder, tab_index):
         file_folder = Path(folder)
@@ -274,22 +442,56 @@ class Grid(QWidget):
         else:
             files = list(file_folder.glob('*.gif'))
 
-        for i in reversed(range(self.layout.count())):
-            widget = self.layout.itemAt(i).widget()
+        self.clear()
+
+        for file in files:
+            self.layout.addWidget(self.make_label(file))
+
+    def clear(self):
+        """
+        Удаляет все изображения из сетки и снимает выделение.
+        """
+        while self.layout.count():
+            widget = self.layout.takeAt(self.layout.count() - 1).widget()
             if widget is not None:
                 widget.deleteLater()
+        self.selected.clear()
 
-        row, col = 0, 0
-        for file in files:
-            label = MediaLabel(parent=self.parent(), file=file)
-            label.mousePressEvent = lambda event, f=file: self.open_viewer(event, f)
+    def make_label(self, file):
+        """
+        Создаёт виджет для отображения файла в сетке.
+        :param file: Путь к изображению/анимации.
+        :return: Объект MediaLabel.
+        """
+        label = MediaLabel(parent=self.parent(), file=file)
+        label.mousePressEvent = lambda event, lb=label: self.on_label_pressed(event, lb)
+        return label
 
-            self.layout.addWidget(label, row, col)
+    def on_label_pressed(self, event, label):
+        """
+        Обрабатывает нажатие на изображение: щелчок с зажатым Ctrl выделяет изображение
+        или снимает с него выделение, обычный щелчок открывает окно просмотра.
+        """
+        if (event.button() == Qt.MouseButton.LeftButton
+                and event.modifiers() & Qt.KeyboardModifier.ControlModifier):
+            self.toggle_selection(label)
+        else:
+            self.open_viewer(event, label.file)
+
+    def toggle_selection(self, label):
+        if label.file in self.selected:
+            self.selected.discard(label.file)
+            label.set_selected(False)
+        else:
+            self.selected.add(label.file)
+            label.set_selected(True)
 
-            col += 1
-            if col >= 4:
-                col = 0
-                row += 1
+    def clear_selection(self):
+        for i in range(self.layout.count()):
+            widget = self.layout.itemAt(i).widget()
+            if isinstance(widget, MediaLabel):
+                widget.set_selected(False)
+        self.selected.clear()
 
     @staticmethod
     def open_viewer(event, file):
@@ -307,6 +509,7 @@ class MediaLabel(QLabel):
         super().__init__()
         self.setParent(parent)
         self.file = Path(file)
+        self.setObjectName("MediaLabel")
         self.setFixedSize(200, 200)
         self.setAlignment(Qt.AlignmentFlag.AlignCenter)
 
@@ -333,10 +536,38 @@ class MediaLabel(QLabel):
         deleting_tag = QAction("Удалить тег", self)
         deleting_tag.triggered.connect(lambda: self.window().delete_tag())
 
+        renaming_tag = QAction("Редактировать тег", self)
+        renaming_tag.triggered.connect(lambda: self.window().rename_tag())
+
         context_menu.addAction(adding_tag)
         context_menu.addAction(deleting_tag)
+        context_menu.addAction(renaming_tag)
         context_menu.addAction(deleting_media)
 
+        grid = self.parentWidget()
+        if isinstance(grid, Grid) and grid.selected:
+            files = sorted(grid.selected)
+
+            context_menu.addSeparator()
+            adding_tag_selected = QAction(f"Добавить тег к выбранным ({len(files)})", self)
+            adding_tag_selected.triggered.connect(
+                lambda: self.window().add_tag_to_selected(files))
+
+            deleting_tag_selected = QAction(f"Удалить тег у выбранных ({len(files)})", self)
+            deleting_tag_selected.triggered.connect(
+                lambda: self.window().delete_tag_from_selected(files))
+
+            clearing_selection = QAction("Снять выделение", self)
+            clearing_selection.triggered.connect(grid.clear_selection)
+
+            context_menu.addAction(adding_tag_selected)
+            context_menu.addAction(deleting_tag_selected)
+            context_menu.addAction(clearing_selection)
+
+        searching_color = QAction("Найти похожие по цвету", self)
+        searching_color.triggered.connect(lambda: self.window().show_similar_colors(self.file))
+        context_menu.addAction(searching_color)
+
         if self.file.suffix.lower() != '.gif':
             copying_image = QAction("Копировать изображение", self)
             copying_image.triggered.connect(lambda: self.copy_to_clipboard(self.file))
@@ -344,6 +575,15 @@ class MediaLabel(QLabel):
 
         context_menu.exec(self.mapToGlobal(ev.pos()))
 
+    def set_selected(self, selected):
+        """
+        Помечает изображение как выделенное или снимает выделение.
+        :param selected: True, если изображение выделено.
+        """
+        self.setProperty("selected", selected)
+        self.style().unpolish(self)
+        self.style().polish(self)
+
     @staticmethod
     def copy_to_clipboard(file):
         """
@@ -417,6 +657,7 @@ class MediaViewer(QDialog):
             item = self.tags_layout.itemAt(i)
             if item and item.widget():
                 item.widget().deleteLater()
+        self.tag_frames = {}
 
         for tag in self.tags:
             tag_frame = QFrame()
@@ -437,6 +678,7 @@ class MediaViewer(QDialog):
             tag_frame.layout().addWidget(remove_btn)
 
             self.tags_layout.addWidget(tag_frame)
+            self.tag_frames[tag] = tag_frame
 
     def confirm_delete_tag(self, tag):
         reply = QMessageBox.question(
@@ -451,14 +693,18 @@ class MediaViewer(QDialog):
                 file_id = sql.get_image_id(self.file_path)
                 sql.disconnect_tag_from_image(file_id, tag_id)
                 self.tags.remove(tag)
-                self.render_tags()
+                tag_frame = self.tag_frames.pop(tag)
+                self.tags_layout.removeWidget(tag_frame)
+                tag_frame.deleteLater()
             except Exception as e:
                 QMessageBox.critical(self, "Ошибка", f"Не удалось удалить тег: {e}")
 
 
-app = QApplication(sys.argv)
-with open("PicSearch\style.qss", "r", encoding="utf-8") as f:
-    app.setStyleSheet(f.read())
-main_window = MainWindow()
-main_window.show()
-app.exec()
+if __name__ == '__main__':
+    # Проверка нужна, чтобы процессы пула metadata.extract_batches не запускали приложение заново.
+    app = QApplication(sys.argv)
+    with open("PicSearch\style.qss", "r", encoding="utf-8") as f:
+        app.setStyleSheet(f.read())
+    main_window = MainWindow()
+    main_window.show()
+    app.exec()
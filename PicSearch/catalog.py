@@ -0,0 +1,227 @@
+"""
+Модуль содержит функции для экспорта и импорта каталога (изображения, теги и их связи)
+в переносимый файл формата NDJSON (одна JSON-запись на строку).
+
+Пути к изображениям сохраняются относительно директории с изображениями, поэтому каталог
+можно перенести на другой компьютер или в другую операционную систему. Сами файлы
+изображений копируются отдельно, вместе с директорией.
+
+Запуск из командной строки:
+    python -m PicSearch.catalog export catalog.ndjson.gz
+    python -m PicSearch.catalog import catalog.ndjson.gz
+"""
+import argparse
+import gzip
+import io
+import json
+import sys
+from pathlib import Path, PurePosixPath, PureWindowsPath
+from PicSearch import sql
+
+CATALOG_FORMAT = "picsearch-catalog"
+CATALOG_VERSION = 1
+
+# Количество строк, которые за один раз передаются между базой данных и приложением.
+BATCH_SIZE = 5000
+
+
+def get_media_dir():
+    """
+    Получает путь к директории, где хранятся изображения и анимации.
+    :return: Путь к директории из файла 'dir_check.txt'.
+    """
+    with open(Path('PicSearch') / 'dir_check.txt', 'r') as f:
+        return f.read().strip()
+
+
+def open_catalog(path, mode):
+    """
+    Открывает файл каталога. Файлы с расширением '.gz' сжимаются gzip.
+    :param path: Путь к файлу каталога.
+    :param mode: 'r' для чтения или 'w' для записи.
+    :return: Текстовый файловый объект.
+    """
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8', newline='\n')
+
+
+def to_relative(image_path, media_dir):
+    """
+    Преобразует путь к изображению из базы данных в переносимый относительный путь.
+    Пути разбираются как пути Windows, так как такой разбор понимает оба вида разделителей.
+    :param image_path: Путь к изображению в базе данных.
+    :param media_dir: Директория с изображениями.
+    :return: Путь относительно директории с изображениями с разделителями '/'.
+    """
+    path = PureWindowsPath(image_path)
+    try:
+        return path.relative_to(PureWindowsPath(media_dir)).as_posix()
+    except ValueError:
+        return path.name
+
+
+def to_absolute(relative_path, media_dir):
+    """
+    Преобразует относительный путь из каталога в путь внутри директории с изображениями.
+    :param relative_path: Путь из каталога с разделителями '/'.
+    :param media_dir: Директория с изображениями.
+    :return: Путь к изображению в формате текущей операционной системы.
+    """
+    parts = PurePosixPath(relative_path).parts
+    if not parts or PurePosixPath(relative_path).is_absolute() or '..' in parts:
+        raise ValueError(f"Недопустимый путь в каталоге: {relative_path}")
+    return sql.to_db_path(Path(media_dir).joinpath(*parts))
+
+
+def export_catalog(catalog_path, media_dir):
+    """
+    Экспортирует каталог в файл. Строки читаются серверными курсорами порциями
+    по BATCH_SIZE, поэтому каталог не загружается в память целиком.
+    :param catalog_path: Путь к файлу, в который записывается каталог.
+    :param media_dir: Директория с изображениями.
+    :return: Количество экспортированных изображений.
+    """
+    try:
+        count = 0
+        with open_catalog(catalog_path, 'w') as f:
+            header = {'format': CATALOG_FORMAT, 'version': CATALOG_VERSION}
+            f.write(json.dumps(header) + '\n')
+
+            with sql.get_connection().cursor(name='catalog_export_tags') as tag_cursor:
+                tag_cursor.itersize = BATCH_SIZE
+                tag_cursor.execute("SELECT tag_name FROM tags ORDER BY id")
+                for tag_name, in tag_cursor:
+                    f.write(json.dumps({'tag': tag_name}, ensure_ascii=False) + '\n')
+
+            select_query = ("SELECT i.image_path, "
+                            "array_remove(array_agg(t.tag_name ORDER BY t.tag_name), NULL) "
+                            "FROM images i "
+                            "LEFT JOIN image_tags it ON it.image_id = i.id "
+                            "LEFT JOIN tags t ON t.id = it.tag_id "
+                            "GROUP BY i.id, i.image_path ORDER BY i.id")
+            with sql.get_connection().cursor(name='catalog_export_images') as image_cursor:
+                image_cursor.itersize = BATCH_SIZE
+                image_cursor.execute(select_query)
+                for image_path, tags in image_cursor:
+                    record = {'path': to_relative(image_path, media_dir), 'tags': tags}
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    count += 1
+
+        sql.get_connection().commit()
+        print(f"Каталог экспортирован, изображений: {count}.")
+        return count
+
+    except Exception as e:
+        sql.get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def _copy_value(value):
+    """
+    Экранирует значение для текстового формата команды COPY.
+    """
+    if value is None:
+        return '\\N'
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def _flush(buffer):
+    """
+    Передаёт накопленные строки во временную таблицу командой COPY и очищает буфер.
+    """
+    buffer.seek(0)
+    sql.get_cursor().copy_expert("COPY catalog_import (image_path, tag_name) FROM STDIN", buffer)
+    buffer.seek(0)
+    buffer.truncate()
+
+
+def import_catalog(catalog_path, media_dir):
+    """
+    Импортирует каталог из файла. Записи читаются построчно и порциями по BATCH_SIZE
+    загружаются командой COPY во временную таблицу, после чего изображения, теги и связи
+    добавляются тремя запросами. Уже существующие записи не дублируются.
+    Импорт выполняется в одной транзакции.
+    :param catalog_path: Путь к файлу каталога.
+    :param media_dir: Директория с изображениями на этом компьютере.
+    :return: Количество добавленных изображений.
+    """
+    sql.create_image_tags_index()
+    try:
+        cursor = sql.get_cursor()
+        cursor.execute("CREATE TEMP TABLE catalog_import (image_path text, tag_name text) "
+                       "ON COMMIT DROP")
+
+        buffer = io.StringIO()
+        rows = 0
+        with open_catalog(catalog_path, 'r') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('format') != CATALOG_FORMAT or header.get('version') != CATALOG_VERSION:
+                raise ValueError("Файл не является каталогом PicSearch.")
+
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+
+                if 'tag' in record:
+                    pairs = [(None, record['tag'])]
+                else:
+                    image_path = to_absolute(record['path'], media_dir)
+                    pairs = [(image_path, tag) for tag in record.get('tags') or [None]]
+
+                for image_path, tag in pairs:
+                    buffer.write(f"{_copy_value(image_path)}\t{_copy_value(tag)}\n")
+                    rows += 1
+
+                if rows >= BATCH_SIZE:
+                    _flush(buffer)
+                    rows = 0
+
+        if rows:
+            _flush(buffer)
+
+        cursor.execute("INSERT INTO images (image_path) "
+                       "SELECT DISTINCT s.image_path FROM catalog_import s "
+                       "WHERE s.image_path IS NOT NULL AND NOT EXISTS "
+                       "(SELECT 1 FROM images i WHERE i.image_path = s.image_path)")
+        count = cursor.rowcount
+
+        cursor.execute("INSERT INTO tags (tag_name) "
+                       "SELECT DISTINCT s.tag_name FROM catalog_import s "
+                       "WHERE s.tag_name IS NOT NULL AND NOT EXISTS "
+                       "(SELECT 1 FROM tags t WHERE t.tag_name = s.tag_name)")
+
+        cursor.execute("INSERT INTO image_tags (image_id, tag_id) "
+                       "SELECT DISTINCT i.id, t.id FROM catalog_import s "
+                       "JOIN images i ON i.image_path = s.image_path "
+                       "JOIN tags t ON t.tag_name = s.tag_name "
+                       "ON CONFLICT DO NOTHING")
+
+        sql.get_connection().commit()
+        print(f"Каталог импортирован, добавлено изображений: {count}.")
+        return count
+
+    except Exception as e:
+        sql.get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m PicSearch.catalog',
+                                     description="Экспорт и импорт каталога PicSearch.")
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', help="Файл каталога (.ndjson или .ndjson.gz).")
+    parser.add_argument('--media-dir', default=None,
+                        help="Директория с изображениями. По умолчанию берётся "
+                             "из файла 'dir_check.txt'.")
+    args = parser.parse_args()
+
+    directory = args.media_dir or get_media_dir()
+    if args.command == 'export':
+        result = export_catalog(args.file, directory)
+    else:
+        result = import_catalog(args.file, directory)
+    if result is None:
+        sys.exit(1)
@@ -0,0 +1,219 @@
+"""
+Модуль содержит функции для поиска изображений по цвету.
+
+Для каждого изображения вычисляется цветовая сигнатура — нормированная гистограмма цветов,
+квантованных до BINS уровней на канал. Сигнатуры хранятся в базе данных вместе с изображением,
+а для поиска собираются в индекс: непрерывную матрицу float32 в файле INDEX_PATH
+и соответствующие ей айди изображений в файле IDS_PATH. При поиске матрица отображается
+в память, а расстояния до всех изображений считаются векторно.
+"""
+import os
+from pathlib import Path
+import numpy as np
+
+# Количество уровней квантования на канал RGB.
+BINS = 4
+SIGNATURE_SIZE = BINS ** 3
+# Размер, до которого уменьшается изображение перед построением гистограммы.
+THUMBNAIL_SIZE = (64, 64)
+
+INDEX_PATH = Path('PicSearch') / 'color_index.bin'
+IDS_PATH = Path('PicSearch') / 'color_index_ids.bin'
+
+# Оба файла индекса начинаются с заголовка: сигнатура формата, количество строк (uint64)
+# и случайная метка построения, общая для пары файлов. Размер заголовка кратен 4,
+# поэтому данные после него выровнены для float32 и int32.
+MAGIC = b'PSCOLOR1'
+HEADER_SIZE = len(MAGIC) + 8 + 8
+
+# Количество строк матрицы, обрабатываемых за один шаг поиска.
+CHUNK_SIZE = 65536
+
+
+def _histogram(pixels):
+    """
+    Строит нормированную гистограмму квантованных цветов.
+    :param pixels: Массив uint8 формы (N, 3).
+    :return: Сигнатура — массив float32 длины SIGNATURE_SIZE с суммой 1.
+    """
+    quantized = pixels.astype(np.uint16) * BINS // 256
+    bins = (quantized[:, 0] * BINS + quantized[:, 1]) * BINS + quantized[:, 2]
+    histogram = np.bincount(bins, minlength=SIGNATURE_SIZE).astype(np.float32)
+    return histogram / max(histogram.sum(), 1)
+
+
+def compute_signature(image):
+    """
+    Вычисляет цветовую сигнатуру изображения. Изображение уменьшается до THUMBNAIL_SIZE
+    на месте, а для JPEG декодируется сразу в уменьшенном размере, поэтому размеры
+    и EXIF нужно прочитать до вызова.
+    :param image: Открытое изображение PIL.
+    :return: Сигнатура — массив float32 длины SIGNATURE_SIZE.
+    """
+    image.draft('RGB', THUMBNAIL_SIZE)
+    image.thumbnail(THUMBNAIL_SIZE)
+    return _histogram(np.asarray(image.convert('RGB')).reshape(-1, 3))
+
+
+def palette_signature(colors):
+    """
+    Строит сигнатуру для набора цветов, в котором все цвета имеют одинаковый вес.
+    :param colors: Список цветов в виде кортежей (r, g, b).
+    :return: Сигнатура — массив float32 длины SIGNATURE_SIZE.
+    """
+    return _histogram(np.array(colors, dtype=np.uint8).reshape(-1, 3))
+
+
+def to_bytes(signature):
+    """
+    Преобразует сигнатуру в байты для хранения в базе данных.
+    """
+    return np.asarray(signature, dtype=np.float32).tobytes()
+
+
+def from_bytes(data):
+    """
+    Преобразует байты из базы данных в сигнатуру.
+    """
+    return np.frombuffer(data, dtype=np.float32)
+
+
+def _write_header(file, count, token):
+    file.seek(0)
+    file.write(MAGIC + np.uint64(count).tobytes() + token)
+
+
+def _read_header(path):
+    """
+    Читает заголовок файла индекса.
+    :return: Пара (количество строк, метка построения) или None, если заголовок повреждён.
+    """
+    with open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        return None
+    count = int(np.frombuffer(header, dtype=np.uint64, count=1, offset=len(MAGIC))[0])
+    return count, header[len(MAGIC) + 8:]
+
+
+def index_size():
+    """
+    Проверяет, что файлы индекса существуют и согласованы между собой.
+    :return: Количество изображений в индексе или None, если индекс отсутствует или повреждён.
+    """
+    try:
+        index_header = _read_header(INDEX_PATH)
+        ids_header = _read_header(IDS_PATH)
+        index_bytes = INDEX_PATH.stat().st_size
+        ids_bytes = IDS_PATH.stat().st_size
+    except FileNotFoundError:
+        return None
+
+    if index_header is None or index_header != ids_header:
+        return None
+    count = index_header[0]
+    if (index_bytes != HEADER_SIZE + count * SIGNATURE_SIZE * 4
+            or ids_bytes != HEADER_SIZE + count * 4):
+        return None
+    return count
+
+
+def rebuild_index(rows):
+    """
+    Перестраивает индекс. Строки записываются в файл по мере поступления, поэтому
+    все сигнатуры не загружаются в память одновременно. Файлы индекса заменяются
+    только после полной записи; при ошибке временные файлы удаляются, а ошибка
+    передаётся вызывающему коду.
+    :param rows: Итерируемый объект пар (айди изображения, сигнатура в байтах).
+    :return: Количество изображений в индексе.
+    """
+    index_tmp = INDEX_PATH.with_suffix('.tmp')
+    ids_tmp = IDS_PATH.with_suffix('.tmp')
+    token = os.urandom(8)
+    count = 0
+    try:
+        with open(index_tmp, 'wb') as index_file, open(ids_tmp, 'wb') as ids_file:
+            _write_header(index_file, 0, token)
+            _write_header(ids_file, 0, token)
+            for image_id, data in rows:
+                if len(data) != SIGNATURE_SIZE * 4:
+                    continue
+                index_file.write(data)
+                ids_file.write(np.int32(image_id).tobytes())
+                count += 1
+            _write_header(index_file, count, token)
+            _write_header(ids_file, count, token)
+    except BaseException:
+        index_tmp.unlink(missing_ok=True)
+        ids_tmp.unlink(missing_ok=True)
+        raise
+
+    # Файлы заменяются по очереди; если замена прервётся между ними, метки построения
+    # в заголовках не совпадут, и index_size сообщит о повреждённом индексе.
+    os.replace(index_tmp, INDEX_PATH)
+    os.replace(ids_tmp, IDS_PATH)
+    return count
+
+
+def append_to_index(image_id, signature):
+    """
+    Добавляет сигнатуру одного изображения в конец индекса. Если индекс отсутствует
+    или повреждён, ничего не делает: такой индекс перестраивается при запуске приложения.
+    :param image_id: Айди изображения в базе данных.
+    :param signature: Сигнатура изображения.
+    :return: True, если сигнатура добавлена.
+    """
+    count = index_size()
+    if count is None:
+        return False
+
+    token = _read_header(INDEX_PATH)[1]
+    with open(INDEX_PATH, 'r+b') as index_file, open(IDS_PATH, 'r+b') as ids_file:
+        index_file.seek(0, os.SEEK_END)
+        index_file.write(to_bytes(signature))
+        ids_file.seek(0, os.SEEK_END)
+        ids_file.write(np.int32(image_id).tobytes())
+        _write_header(index_file, count + 1, token)
+        _write_header(ids_file, count + 1, token)
+    return True
+
+
+def search(signature, limit=100, candidates=None):
+    """
+    Находит изображения с ближайшими цветовыми сигнатурами. Расстояние — сумма модулей
+    разностей гистограмм (L1).
+    :param signature: Сигнатура, с которой сравниваются изображения.
+    :param limit: Максимальное количество результатов.
+    :param candidates: Айди изображений, среди которых ведётся поиск, или None для поиска
+        по всему индексу. Фильтры применяются до выбора ближайших, поэтому результат
+        не ограничивается ближайшими изображениями всей библиотеки.
+    :return: Список айди изображений, отсортированный по возрастанию расстояния.
+    :raises ValueError: Если индекс отсутствует или повреждён.
+    """
+    count = index_size()
+    if count is None:
+        raise ValueError("Индекс цветов отсутствует или повреждён.")
+    if count == 0:
+        return []
+
+    matrix = np.memmap(INDEX_PATH, dtype=np.float32, mode='r', offset=HEADER_SIZE,
+                       shape=(count, SIGNATURE_SIZE))
+    ids = np.fromfile(IDS_PATH, dtype=np.int32, offset=HEADER_SIZE)
+    signature = np.asarray(signature, dtype=np.float32)
+
+    if candidates is None:
+        rows = np.arange(count)
+    else:
+        rows = np.flatnonzero(np.isin(ids, np.asarray(candidates, dtype=np.int32)))
+
+    distances = np.empty(len(rows), dtype=np.float32)
+    for start in range(0, len(rows), CHUNK_SIZE):
+        chunk = matrix[rows[start:start + CHUNK_SIZE]]
+        distances[start:start + len(chunk)] = np.abs(chunk - signature).sum(axis=1)
+
+    limit = min(limit, len(rows))
+    if limit == 0:
+        return []
+    nearest = np.argpartition(distances, limit - 1)[:limit]
+    nearest = nearest[np.argsort(distances[nearest], kind='stable')]
+    return ids[rows[nearest]].tolist()
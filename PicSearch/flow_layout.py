@@ -1,25 +1,60 @@
-from PySide6.QtWidgets import QLayout, QSizePolicy
+"""
+Модуль содержит компоновщик FlowLayout, который размещает элементы слева направо,
+перенося их на новую строку, когда заканчивается ширина.
+"""
+from PySide6.QtWidgets import QLayout
 from PySide6.QtCore import QRect, QPoint, QSize
 
 
 class FlowLayout(QLayout):
+    """
+    Поточный компоновщик с кэшированием геометрии.
+
+    Размеры элементов запрашиваются один раз и хранятся в кэше, результат heightForWidth
+    запоминается для каждой ширины. При добавлении или удалении элемента пересчитываются
+    только позиции, начиная со строки, в которой находится первый изменённый элемент.
+    """
+
     def __init__(self, parent=None, margin=0, spacing=6):
         super().__init__(parent)
         self.setContentsMargins(margin, margin, margin, margin)
         self.setSpacing(spacing)
         self.item_list = []
 
+        # Кэш sizeHint элементов, параллельный item_list.
+        self._hints = []
+        # Позиции элементов, рассчитанные для последней области размещения _area.
+        self._positions = []
+        self._area = QRect()
+        # Высота занятой области или None, если её нужно пересчитать.
+        self._height = None
+        # Индекс первого элемента, позиция которого могла измениться.
+        self._dirty_from = 0
+        # Кэш heightForWidth: ширина -> высота.
+        self._heights = {}
+        self._min_size = None
+        self._spacing = spacing
+        self._margins = self.contentsMargins()
+        # Флаг, что размеры виджетов могли измениться (выставляется в invalidate).
+        self._stale = False
+
     def addItem(self, item):
         self.item_list.append(item)
+        self._hints.append(item.sizeHint())
+        self._positions.append(QPoint())
+        self._mark_dirty(len(self.item_list) - 1)
 
     def count(self):
         return len(self.item_list)
 
     def itemAt(self, index):
-        return self.item_list[index] if index < len(self.item_list) else None
+        return self.item_list[index] if 0 <= index < len(self.item_list) else None
 
     def takeAt(self, index):
         if 0 <= index < len(self.item_list):
+            del self._hints[index]
+            del self._positions[index]
+            self._mark_dirty(index)
             return self.item_list.pop(index)
         return None
 
@@ -30,7 +65,10 @@ class FlowLayout(QLayout):
         return True
 
     def heightForWidth(self, width):
-        return self.do_layout(QRect(0, 0, width, 0), True)
+        self._refresh()
+        if width not in self._heights:
+            self._heights[width] = self.do_layout(QRect(0, 0, width, 0), True)
+        return self._heights[width]
 
     def setGeometry(self, rect):
         super().setGeometry(rect)
@@ -40,26 +78,102 @@ class FlowLayout(QLayout):
         return self.minimumSize()
 
     def minimumSize(self):
-        size = QSize()
-        for item in self.item_list:
-            size = size.expandedTo(item.minimumSize())
-        return size + QSize(2 * self.contentsMargins().top(), 2 * self.contentsMargins().top())
+        self._refresh()
+        if self._min_size is None:
+            size = QSize()
+            for item in self.item_list:
+                size = size.expandedTo(item.minimumSize())
+            margins = self.contentsMargins()
+            self._min_size = size + QSize(margins.left() + margins.right(),
+                                          margins.top() + margins.bottom())
+        return self._min_size
+
+    def invalidate(self):
+        # Qt вызывает invalidate и при изменении размеров виджетов, и при каждой активации
+        # компоновщика, поэтому кэш не сбрасывается сразу: при следующем расчёте размеры
+        # элементов сверяются с сохранёнными, и пересчёт идёт только от первого изменённого.
+        self._stale = True
+        super().invalidate()
 
     def do_layout(self, rect, test_only):
-        x, y = rect.x(), rect.y()
+        """
+        Рассчитывает позиции элементов внутри прямоугольника.
+        :param rect: Прямоугольник, в котором размещаются элементы.
+        :param test_only: Если True, только вычисляет высоту, не перемещая элементы.
+        :return: Высота, необходимая для размещения всех элементов.
+        """
+        self._refresh()
+        margins = self.contentsMargins()
+        area = rect.adjusted(margins.left(), margins.top(), -margins.right(), -margins.bottom())
+
+        if test_only:
+            positions = [QPoint()] * len(self.item_list)
+            return self._place(area, 0, positions) + margins.top() + margins.bottom()
+
+        start = self._dirty_from if area == self._area else 0
+        self._area = area
+        self._dirty_from = len(self.item_list)
+
+        if start < len(self.item_list) or self._height is None:
+            # Элементы до строки, предшествующей изменённому элементу, остаются на месте:
+            # пересчёт начинается с первого элемента этой строки. Если удалён последний
+            # элемент, позиции не меняются, но высота пересчитывается по последней строке.
+            if start > 0:
+                start -= 1
+            while start > 0 and self._positions[start].x() != area.x():
+                start -= 1
+            self._height = self._place(area, start, self._positions)
+            for i in range(start, len(self.item_list)):
+                self.item_list[i].setGeometry(QRect(self._positions[i], self._hints[i]))
+
+        return self._height + margins.top() + margins.bottom()
+
+    def _place(self, area, start, positions):
+        """
+        Заполняет positions координатами элементов, начиная с индекса start.
+        Элемент с индексом start должен начинать строку.
+        :return: Высота занятой области.
+        """
+        space = self.spacing()
+        x = area.x()
+        y = positions[start].y() if start > 0 else area.y()
         line_height = 0
-        for item in self.item_list:
-            wid = item.widget()
-            space_x = self.spacing()
-            space_y = self.spacing()
-            next_x = x + item.sizeHint().width() + space_x
-            if next_x - space_x > rect.right() and line_height > 0:
-                x = rect.x()
-                y = y + line_height + space_y
-                next_x = x + item.sizeHint().width() + space_x
+        for i in range(start, len(self.item_list)):
+            hint = self._hints[i]
+            next_x = x + hint.width() + space
+            if next_x - space > area.right() and line_height > 0:
+                x = area.x()
+                y = y + line_height + space
+                next_x = x + hint.width() + space
                 line_height = 0
-            if not test_only:
-                item.setGeometry(QRect(QPoint(x, y), item.sizeHint()))
+            positions[i] = QPoint(x, y)
             x = next_x
-            line_height = max(line_height, item.sizeHint().height())
-        return y + line_height - rect.y()
+            line_height = max(line_height, hint.height())
+        return y + line_height - area.y()
+
+    def _mark_dirty(self, index):
+        self._dirty_from = min(self._dirty_from, index)
+        self._height = None
+        self._heights.clear()
+        self._min_size = None
+
+    def _refresh(self):
+        """
+        Сверяет сохранённые размеры элементов с текущими после вызова invalidate
+        и помечает для пересчёта элементы, начиная с первого изменившегося.
+        """
+        if not self._stale:
+            return
+        self._stale = False
+        self._min_size = None
+
+        if self.spacing() != self._spacing or self.contentsMargins() != self._margins:
+            self._spacing = self.spacing()
+            self._margins = self.contentsMargins()
+            self._mark_dirty(0)
+
+        for i, item in enumerate(self.item_list):
+            hint = item.sizeHint()
+            if hint != self._hints[i]:
+                self._hints[i] = hint
+                self._mark_dirty(i)
@@ -0,0 +1,166 @@
+"""
+Модуль содержит функции для извлечения метаданных изображений (размеры, формат, размер файла,
+дата съёмки, камера, ориентация и цветовая сигнатура) и для разбора фильтров по метаданным
+в поисковой строке.
+
+Модуль не обращается к базе данных, поэтому его функции можно выполнять в отдельных процессах.
+"""
+import re
+from concurrent.futures import CancelledError
+from datetime import datetime
+from pathlib import Path
+from PIL import Image
+from PicSearch import color_index
+
+# Теги EXIF.
+EXIF_MAKE = 271
+EXIF_MODEL = 272
+EXIF_ORIENTATION = 274
+EXIF_DATETIME = 306
+EXIF_IFD = 0x8769
+EXIF_DATETIME_ORIGINAL = 36867
+
+# Значения ориентации EXIF, при которых изображение повёрнуто на 90 градусов.
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Количество изображений в одной порции, которая сохраняется в базу данных.
+BATCH_SIZE = 256
+
+# Столбцы таблицы images, в которых хранятся метаданные, и их типы в PostgreSQL.
+METADATA_COLUMNS = {
+    'width': 'integer',
+    'height': 'integer',
+    'format': 'text',
+    'file_size': 'bigint',
+    'taken_at': 'timestamp',
+    'camera': 'text',
+    'orientation': 'smallint',
+    'color_signature': 'bytea',
+}
+
+
+def parse_exif_datetime(value):
+    """
+    Преобразует дату из EXIF (формат 'ГГГГ:ММ:ДД ЧЧ:ММ:СС') в объект datetime.
+    :param value: Строка с датой.
+    :return: Объект datetime или None, если дату не удалось разобрать.
+    """
+    try:
+        return datetime.strptime(str(value).strip('\x00 '), '%Y:%m:%d %H:%M:%S')
+    except ValueError:
+        return None
+
+
+def extract_metadata(image_path):
+    """
+    Извлекает метаданные изображения и вычисляет его цветовую сигнатуру
+    по уменьшенной копии.
+    :param image_path: Путь к изображению.
+    :return: Словарь со значениями столбцов METADATA_COLUMNS или None, если файл не удалось открыть.
+    """
+    try:
+        with Image.open(image_path) as image:
+            width, height = image.size
+            exif = image.getexif()
+            image_format = image.format
+            signature = color_index.compute_signature(image)
+
+        orientation = exif.get(EXIF_ORIENTATION)
+        if orientation in ROTATED_ORIENTATIONS:
+            width, height = height, width
+
+        taken_at = exif.get_ifd(EXIF_IFD).get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+        camera = " ".join(str(exif[tag]).strip('\x00 ') for tag in (EXIF_MAKE, EXIF_MODEL)
+                          if exif.get(tag))
+
+        return {
+            'width': width,
+            'height': height,
+            'format': image_format,
+            'file_size': Path(image_path).stat().st_size,
+            'taken_at': parse_exif_datetime(taken_at) if taken_at else None,
+            'camera': camera or None,
+            'orientation': orientation,
+            'color_signature': color_index.to_bytes(signature),
+        }
+
+    except Exception as e:
+        print(f"Не удалось прочитать метаданные {image_path}: {e}")
+        return None
+
+
+def extract_batches(image_paths, executor, batch_size=BATCH_SIZE):
+    """
+    Извлекает метаданные изображений параллельно в пуле процессов и возвращает результат
+    порциями, чтобы его можно было сохранять по мере готовности. Если пул остановлен
+    (executor.shutdown(cancel_futures=True)), выдача порций прекращается.
+    :param image_paths: Пути к изображениям.
+    :param executor: Пул процессов ProcessPoolExecutor.
+    :param batch_size: Количество изображений в одной порции.
+    :return: Генератор списков пар (путь, метаданные); для файлов, которые не удалось
+        прочитать, вместо метаданных передаётся None.
+    """
+    image_paths = list(image_paths)
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        try:
+            results = list(executor.map(extract_metadata, batch, chunksize=16))
+        except (CancelledError, RuntimeError):
+            # RuntimeError возникает при добавлении задач в уже остановленный пул.
+            return
+        yield list(zip(batch, results))
+
+
+# Фильтр вида 'width>4000', 'h<=1080', 'year:2023', 'camera:canon', 'format:png', 'color:#ff8800'.
+FILTER_PATTERN = re.compile(r'^(width|height|w|h|year|camera|format|color)(>=|<=|>|<|=|:)(.+)$',
+                            re.IGNORECASE)
+
+# Допустимый диапазон года в фильтре 'year': для сравнения с датой съёмки берутся
+# границы года и следующего за ним, которые должны помещаться в datetime.
+MIN_YEAR = 1
+MAX_YEAR = 9998
+
+SHAPE_WORDS = {
+    'landscape': 'landscape', 'альбомная': 'landscape', 'горизонтальная': 'landscape',
+    'portrait': 'portrait', 'портретная': 'portrait', 'вертикальная': 'portrait',
+    'square': 'square', 'квадратная': 'square',
+}
+
+
+def parse_query(text):
+    """
+    Выделяет из текста поисковой строки фильтры по метаданным.
+    Поддерживаются слова 'landscape', 'portrait', 'square' (и их русские варианты)
+    и выражения 'width>4000', 'h<=1080', 'year:2023', 'camera:canon', 'format:png'.
+    Выражение 'color:#ff8800,navy' задаёт палитру для поиска по цвету.
+    :param text: Текст поисковой строки.
+    :return: Кортеж (список фильтров (столбец, оператор, значение), оставшийся текст).
+    """
+    filters = []
+    words = []
+    for word in text.split():
+        shape = SHAPE_WORDS.get(word.lower())
+        match = FILTER_PATTERN.match(word)
+        if shape:
+            filters.append(('shape', '=', shape))
+        elif match:
+            key, operator, value = match.groups()
+            key = {'w': 'width', 'h': 'height'}.get(key.lower(), key.lower())
+            operator = '=' if operator == ':' else operator
+            if key in ('width', 'height', 'year'):
+                value = value.lower().removesuffix('px')
+                if not value.isdecimal():
+                    words.append(word)
+                    continue
+                value = int(value)
+                if key == 'year' and not MIN_YEAR <= value <= MAX_YEAR:
+                    words.append(word)
+                    continue
+            elif operator != '=':
+                words.append(word)
+                continue
+            filters.append((key, operator, value))
+        else:
+            words.append(word)
+
+    return filters, " ".join(words)
@@ -2,22 +2,53 @@
 Модуль содержит все функции, взаимодействующие с базой данных с помощью SQL-команд.
 """
 import json
+from datetime import datetime
+from pathlib import Path
 import psycopg2
+from psycopg2.extras import execute_values
+from PicSearch.metadata import METADATA_COLUMNS
 
-with open('PicSearch\config.json') as config_file:
-    config = json.load(config_file)
-    db_name = config['database']['database_name']
-    db_user = config['database']['user']
-    db_password = config['database']['password']
-    db_host = config['database']['host']
-    db_port = config['database']['port']
+# Объект класса connection, обрабатывающий подключение к базе данных PostgreSQl,
+# и объект класса cursor, позволяющий выполнять psql команды в базе данных.
+# Подключение открывается при первом обращении, чтобы импорт модуля (например, в процессах
+# пула metadata.extract_batches) не создавал лишних подключений.
+_connection = None
+_cursor = None
 
-# Объект класса connection, обрабатывающий подключение к базе данных PostgreSQl.
-connection = psycopg2.connect(database=db_name, user=db_user, password=db_password,
-                              host=db_host, port=db_port)
 
-# Объект класса cursor, позволяющий выполнять psql команды в базе данных.
-cursor = connection.cursor()
+def get_connection():
+    """
+    Возвращает подключение к базе данных, открывая его при первом вызове.
+    :return: Объект класса connection.
+    """
+    global _connection, _cursor
+    if _connection is None:
+        with open(Path('PicSearch') / 'config.json') as config_file:
+            config = json.load(config_file)['database']
+        _connection = psycopg2.connect(database=config['database_name'], user=config['user'],
+                                       password=config['password'], host=config['host'],
+                                       port=config['port'])
+        _cursor = _connection.cursor()
+    return _connection
+
+
+def get_cursor():
+    """
+    Возвращает курсор для выполнения команд в базе данных.
+    :return: Объект класса cursor.
+    """
+    get_connection()
+    return _cursor
+
+
+def to_db_path(path):
+    """
+    Приводит путь к изображению к виду, в котором он хранится в базе данных:
+    к пути с разделителями текущей операционной системы.
+    :param path: Путь к изображению (строка или Path).
+    :return: Строка с путём.
+    """
+    return str(Path(path))
 
 
 def add_image_to_db(image_path):
@@ -27,9 +58,9 @@ def add_image_to_db(image_path):
     """
     try:
         insert_query = "INSERT INTO images (image_path) VALUES (%s)"
-        cursor.execute(insert_query, (str(image_path), ))
+        get_cursor().execute(insert_query, (to_db_path(image_path), ))
 
-        connection.commit()
+        get_connection().commit()
         print("Изображение успешно добавлено.")
 
     except Exception as e:
@@ -43,9 +74,9 @@ def delete_image_from_db(image_path):
     """
     try:
         delete_query = "DELETE FROM images WHERE image_path = (%s)"
-        cursor.execute(delete_query, (str(image_path).replace('/', '\\'), ))
+        get_cursor().execute(delete_query, (to_db_path(image_path), ))
 
-        connection.commit()
+        get_connection().commit()
         print("Изображение успешно удалено.")
 
     except Exception as e:
@@ -59,9 +90,9 @@ def add_tag_to_db(tag):
     """
     try:
         insert_query = "INSERT INTO tags (tag_name) VALUES (%s)"
-        cursor.execute(insert_query, (tag, ))
+        get_cursor().execute(insert_query, (tag, ))
 
-        connection.commit()
+        get_connection().commit()
         print("Тег успешно добавлен.")
 
     except Exception as e:
@@ -75,9 +106,9 @@ def delete_tag_from_db(tag):
     """
     try:
         delete_query = "DELETE FROM tags WHERE tag_name = (%s)"
-        cursor.execute(delete_query, (tag, ))
+        get_cursor().execute(delete_query, (tag, ))
 
-        connection.commit()
+        get_connection().commit()
         print("Тег успешно удален.")
 
     except Exception as e:
@@ -92,9 +123,9 @@ def connect_tag_to_image(image_id, tag_id):
     """
     try:
         insert_query = "INSERT INTO image_tags (image_id, tag_id) VALUES(%s, %s)"
-        cursor.execute(insert_query, (image_id, tag_id, ))
+        get_cursor().execute(insert_query, (image_id, tag_id, ))
 
-        connection.commit()
+        get_connection().commit()
         print("Тег привязан к изображению.")
 
     except Exception as e:
@@ -104,9 +135,9 @@ def connect_tag_to_image(image_id, tag_id):
 def disconnect_tag_from_image(image_id, tag_id):
     try:
         delete_query = "DELETE FROM image_tags WHERE image_id = (%s) AND tag_id = (%s)"
-        cursor.execute(delete_query, (image_id, tag_id, ))
+        get_cursor().execute(delete_query, (image_id, tag_id, ))
 
-        connection.commit()
+        get_connection().commit()
         print("Тег отвязан от изображения.")
 
     except Exception as e:
@@ -121,9 +152,9 @@ def check_path(image_path):
     """
     try:
         check_query = "SELECT id FROM images WHERE image_path = (%s)"
-        cursor.execute(check_query, (str(image_path).replace('/', '\\'), ))
+        get_cursor().execute(check_query, (to_db_path(image_path), ))
 
-        return cursor.rowcount > 0
+        return get_cursor().rowcount > 0
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
@@ -132,9 +163,9 @@ def check_path(image_path):
 def check_tag(tag_id, image_id):
     try:
         check_query = "SELECT * FROM image_tags WHERE tag_id = (%s) AND image_id = (%s)"
-        cursor.execute(check_query, (tag_id, image_id, ))
+        get_cursor().execute(check_query, (tag_id, image_id, ))
 
-        return cursor.rowcount > 0
+        return get_cursor().rowcount > 0
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
@@ -148,9 +179,9 @@ def get_tag_id(tag):
     """
     try:
         select_query = "SELECT id FROM tags WHERE tag_name = (%s)"
-        cursor.execute(select_query, (tag, ))
+        get_cursor().execute(select_query, (tag, ))
 
-        return cursor.fetchone()
+        return get_cursor().fetchone()
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
@@ -164,9 +195,9 @@ def get_image_id(file):
     """
     try:
         select_query = "SELECT id FROM images WHERE image_path = (%s)"
-        cursor.execute(select_query, (str(file).replace('/', '\\'), ))
+        get_cursor().execute(select_query, (to_db_path(file), ))
 
-        return cursor.fetchone()
+        return get_cursor().fetchone()
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
@@ -180,14 +211,14 @@ def get_tags_for_image(image_id):
     """
     try:
         image_select_query = "SELECT tag_id FROM image_tags WHERE image_id = (%s)"
-        cursor.execute(image_select_query, (image_id, ))
-        tag_ids = cursor.fetchall()
+        get_cursor().execute(image_select_query, (image_id, ))
+        tag_ids = get_cursor().fetchall()
 
         tag_select_query = "SELECT tag_name FROM tags WHERE id = (%s)"
         tags = []
         for tag in tag_ids:
-            cursor.execute(tag_select_query, (tag[0], ))
-            tag_name = cursor.fetchone()
+            get_cursor().execute(tag_select_query, (tag[0], ))
+            tag_name = get_cursor().fetchone()
             if tag_name:
                 tags.append(tag_name[0])
 
@@ -200,8 +231,8 @@ def get_tags_for_image(image_id):
 def get_images():
     try:
         select_query = "SELECT image_path FROM images"
-        cursor.execute(select_query)
-        images = cursor.fetchall()
+        get_cursor().execute(select_query)
+        images = get_cursor().fetchall()
 
         return images
 
@@ -212,8 +243,8 @@ def get_images():
 def get_tags():
     try:
         select_query = "SELECT tag_name FROM tags"
-        cursor.execute(select_query)
-        cursor_tags = cursor.fetchall()
+        get_cursor().execute(select_query)
+        cursor_tags = get_cursor().fetchall()
 
         tags = []
         for tag in cursor_tags:
@@ -223,3 +254,366 @@ def get_tags():
 
     except Exception as e:
         print(f"Произошла ошибка: {e}")
+
+
+def get_image_ids(files):
+    """
+    Получает айди нескольких изображений одним запросом.
+    :param files: Пути к изображениям, айди которых нужно получить.
+    :return: Список айди изображений.
+    """
+    try:
+        select_query = "SELECT id FROM images WHERE image_path = ANY(%s)"
+        get_cursor().execute(select_query, ([to_db_path(file) for file in files], ))
+
+        return [row[0] for row in get_cursor().fetchall()]
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+
+
+def create_image_tags_index():
+    """
+    Создаёт уникальный индекс по паре (image_id, tag_id) в таблице image_tags, если его ещё нет.
+    Индекс нужен, чтобы массовое добавление тегов не создавало повторяющихся связей.
+    Перед созданием индекса уже существующие повторы удаляются.
+    """
+    try:
+        get_cursor().execute("SELECT to_regclass('image_tags_image_tag_idx')")
+        if get_cursor().fetchone()[0] is not None:
+            get_connection().commit()
+            return
+
+        delete_query = ("DELETE FROM image_tags a USING image_tags b "
+                        "WHERE a.ctid < b.ctid AND a.image_id = b.image_id "
+                        "AND a.tag_id = b.tag_id")
+        get_cursor().execute(delete_query)
+        get_cursor().execute("CREATE UNIQUE INDEX IF NOT EXISTS image_tags_image_tag_idx "
+                             "ON image_tags (image_id, tag_id)")
+
+        get_connection().commit()
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def connect_tag_to_images(image_ids, tag):
+    """
+    Связывает тег сразу с несколькими изображениями. Если тега нет в базе данных,
+    он создаётся. Все изменения выполняются в одной транзакции.
+    :param image_ids: Список айди изображений.
+    :param tag: Тег, который нужно привязать.
+    :return: Количество новых связей тега с изображениями.
+    """
+    try:
+        insert_tag_query = ("INSERT INTO tags (tag_name) SELECT %(tag)s "
+                            "WHERE NOT EXISTS (SELECT 1 FROM tags WHERE tag_name = %(tag)s)")
+        get_cursor().execute(insert_tag_query, {'tag': tag})
+
+        insert_query = ("INSERT INTO image_tags (image_id, tag_id) "
+                        "SELECT unnest(%s::integer[]), (SELECT id FROM tags WHERE tag_name = %s) "
+                        "ON CONFLICT DO NOTHING")
+        get_cursor().execute(insert_query, (list(image_ids), tag, ))
+        added = get_cursor().rowcount
+
+        get_connection().commit()
+        print(f"Тег привязан к изображениям: {added}.")
+        return added
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def disconnect_tag_from_images(image_ids, tag):
+    """
+    Отвязывает тег сразу от нескольких изображений.
+    :param image_ids: Список айди изображений.
+    :param tag: Тег, который нужно отвязать.
+    :return: Количество удалённых связей тега с изображениями.
+    """
+    try:
+        delete_query = ("DELETE FROM image_tags WHERE image_id = ANY(%s::integer[]) "
+                        "AND tag_id = (SELECT id FROM tags WHERE tag_name = %s)")
+        get_cursor().execute(delete_query, (list(image_ids), tag, ))
+        removed = get_cursor().rowcount
+
+        get_connection().commit()
+        print(f"Тег отвязан от изображений: {removed}.")
+        return removed
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def rename_tag(old_tag, new_tag):
+    """
+    Переименовывает тег. Если тег с новым названием уже существует, теги объединяются:
+    все связи старого тега переносятся на существующий, а старый тег удаляется.
+    Все изменения выполняются в одной транзакции.
+    :param old_tag: Текущее название тега.
+    :param new_tag: Новое название тега.
+    :return: True, если тег был переименован или объединён, иначе False.
+    """
+    try:
+        old_id = get_tag_id(old_tag)
+        if not old_id:
+            return False
+
+        new_id = get_tag_id(new_tag)
+        if not new_id:
+            update_query = "UPDATE tags SET tag_name = (%s) WHERE id = (%s)"
+            get_cursor().execute(update_query, (new_tag, old_id[0], ))
+        elif new_id != old_id:
+            move_query = ("INSERT INTO image_tags (image_id, tag_id) "
+                          "SELECT image_id, %s FROM image_tags WHERE tag_id = %s "
+                          "ON CONFLICT DO NOTHING")
+            get_cursor().execute(move_query, (new_id[0], old_id[0], ))
+            get_cursor().execute("DELETE FROM image_tags WHERE tag_id = (%s)", (old_id[0], ))
+            get_cursor().execute("DELETE FROM tags WHERE id = (%s)", (old_id[0], ))
+
+        get_connection().commit()
+        print("Тег успешно переименован.")
+        return True
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+        return False
+
+
+def create_metadata_columns():
+    """
+    Добавляет в таблицу images столбцы и индексы для метаданных изображений,
+    если их ещё нет.
+    """
+    try:
+        alter_query = "ALTER TABLE images " + ", ".join(
+            f"ADD COLUMN IF NOT EXISTS {column} {column_type}"
+            for column, column_type in METADATA_COLUMNS.items())
+        get_cursor().execute(alter_query)
+        # Флаг отмечает файлы, которые не удалось прочитать, чтобы не обрабатывать их
+        # при каждом запуске.
+        get_cursor().execute("ALTER TABLE images ADD COLUMN IF NOT EXISTS metadata_failed boolean "
+                             "NOT NULL DEFAULT false")
+        get_cursor().execute("CREATE INDEX IF NOT EXISTS images_size_idx ON images (width, height)")
+        get_cursor().execute("CREATE INDEX IF NOT EXISTS images_height_idx ON images (height)")
+        get_cursor().execute("CREATE INDEX IF NOT EXISTS images_taken_at_idx ON images (taken_at)")
+        get_cursor().execute("CREATE INDEX IF NOT EXISTS images_format_idx ON images (format)")
+        get_cursor().execute("CREATE INDEX IF NOT EXISTS images_missing_metadata_idx ON images (id) "
+                             "WHERE (file_size IS NULL OR color_signature IS NULL) "
+                             "AND NOT metadata_failed")
+
+        get_connection().commit()
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def get_images_without_metadata():
+    """
+    Получает пути к изображениям, для которых ещё не извлечены метаданные.
+    Файлы, которые не удалось прочитать раньше, пропускаются.
+    :return: Список путей к изображениям.
+    """
+    try:
+        select_query = ("SELECT image_path FROM images "
+                        "WHERE (file_size IS NULL OR color_signature IS NULL) "
+                        "AND NOT metadata_failed")
+        get_cursor().execute(select_query)
+
+        return [row[0] for row in get_cursor().fetchall()]
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+
+
+def update_images_metadata(rows):
+    """
+    Сохраняет метаданные нескольких изображений одним запросом. Изображения, метаданные
+    которых не удалось извлечь, отмечаются флагом metadata_failed.
+    :param rows: Список пар (путь к изображению, словарь метаданных или None).
+    """
+    try:
+        failed = [to_db_path(image_path) for image_path, data in rows if data is None]
+        if failed:
+            get_cursor().execute("UPDATE images SET metadata_failed = true "
+                                 "WHERE image_path = ANY(%s)", (failed, ))
+
+        # Значения NULL в VALUES не имеют типа, поэтому в шаблоне они приводятся
+        # к типам столбцов явно.
+        update_query = ("UPDATE images SET "
+                        + ", ".join(f"{column} = v.{column}" for column in METADATA_COLUMNS)
+                        + ", metadata_failed = false FROM (VALUES %s) AS v(image_path, "
+                        + ", ".join(METADATA_COLUMNS)
+                        + ") WHERE images.image_path = v.image_path")
+        template = ("(%(image_path)s, "
+                    + ", ".join(f"%({column})s::{column_type}"
+                                for column, column_type in METADATA_COLUMNS.items())
+                    + ")")
+        values = [dict(data, image_path=to_db_path(image_path),
+                       color_signature=psycopg2.Binary(data['color_signature']))
+                  for image_path, data in rows if data is not None]
+        if values:
+            execute_values(get_cursor(), update_query, values, template=template)
+
+        get_connection().commit()
+
+    except Exception as e:
+        get_connection().rollback()
+        print(f"Произошла ошибка: {e}")
+
+
+def _contains_pattern(text):
+    """
+    Строит шаблон ILIKE для поиска подстроки: символы '%', '_' и '\\' в тексте экранируются,
+    чтобы сравнивались буквально.
+    """
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+
+def _metadata_conditions(filters):
+    """
+    Преобразует фильтры по метаданным в условия SQL-запроса к таблице images.
+    :param filters: Список фильтров (столбец, оператор, значение) из metadata.parse_query.
+    :return: Пара (список условий, список параметров запроса).
+    """
+    operators = ('=', '>', '<', '>=', '<=')
+    formats = {'JPG': 'JPEG'}
+    shapes = {'landscape': "width > height", 'portrait': "width < height",
+              'square': "width = height"}
+    conditions = []
+    params = []
+    for key, operator, value in filters:
+        if operator not in operators:
+            continue
+        if key in ('width', 'height'):
+            conditions.append(f"{key} {operator} %s")
+            params.append(value)
+        elif key == 'year':
+            # Год сравнивается через границы диапазона, чтобы использовался индекс по дате.
+            start, end = datetime(value, 1, 1), datetime(value + 1, 1, 1)
+            if operator == '=':
+                conditions.append("taken_at >= %s AND taken_at < %s")
+                params.extend([start, end])
+            elif operator in ('>', '>='):
+                conditions.append("taken_at >= %s")
+                params.append(end if operator == '>' else start)
+            else:
+                conditions.append("taken_at < %s")
+                params.append(end if operator == '<=' else start)
+        elif key == 'format':
+            conditions.append("format = %s")
+            params.append(formats.get(value.upper(), value.upper()))
+        elif key == 'camera':
+            conditions.append("camera ILIKE %s")
+            params.append(_contains_pattern(value))
+        elif key == 'shape' and value in shapes:
+            conditions.append(shapes[value])
+    return conditions, params
+
+
+def search_image_ids(filters, extensions=None, tag_text=None):
+    """
+    Получает айди изображений, которые удовлетворяют фильтрам по метаданным,
+    имеют одно из расширений и тег, содержащий заданный текст.
+    :param filters: Список фильтров (столбец, оператор, значение) из metadata.parse_query.
+    :param extensions: Список расширений файлов (например, ['.png', '.jpg']) или None.
+    :param tag_text: Текст, который должен содержаться в одном из тегов, или None.
+    :return: Список айди изображений.
+    """
+    try:
+        conditions, params = _metadata_conditions(filters)
+        if extensions:
+            conditions.append("lower(image_path) LIKE ANY(%s)")
+            params.append([f"%{extension.lower()}" for extension in extensions])
+        if tag_text and tag_text.strip():
+            conditions.append("EXISTS (SELECT 1 FROM image_tags it "
+                              "JOIN tags t ON t.id = it.tag_id "
+                              "WHERE it.image_id = images.id AND t.tag_name ILIKE %s)")
+            params.append(_contains_pattern(tag_text.strip()))
+
+        select_query = "SELECT id FROM images"
+        if conditions:
+            select_query += " WHERE " + " AND ".join(conditions)
+        get_cursor().execute(select_query + " ORDER BY id", params)
+
+        return [row[0] for row in get_cursor().fetchall()]
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+
+
+def get_color_signatures():
+    """
+    Получает цветовые сигнатуры всех изображений. Строки читаются серверным курсором
+    порциями, поэтому все сигнатуры не загружаются в память одновременно.
+    Ошибки не перехватываются, чтобы индекс не был перестроен по неполным данным.
+    :return: Генератор пар (айди изображения, сигнатура в байтах).
+    """
+    try:
+        with get_connection().cursor(name='color_signatures') as signature_cursor:
+            signature_cursor.itersize = 5000
+            signature_cursor.execute("SELECT id, color_signature FROM images "
+                                     "WHERE color_signature IS NOT NULL ORDER BY id")
+            for image_id, signature in signature_cursor:
+                yield image_id, bytes(signature)
+        get_connection().commit()
+
+    except BaseException:
+        get_connection().rollback()
+        raise
+
+
+def count_color_signatures():
+    """
+    Получает количество изображений с вычисленной цветовой сигнатурой.
+    :return: Количество изображений.
+    """
+    try:
+        select_query = "SELECT count(*) FROM images WHERE color_signature IS NOT NULL"
+        get_cursor().execute(select_query)
+
+        return get_cursor().fetchone()[0]
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+
+
+def get_color_signature(file):
+    """
+    Получает цветовую сигнатуру изображения.
+    :param file: Путь к изображению.
+    :return: Сигнатура в байтах или None, если она ещё не вычислена.
+    """
+    try:
+        select_query = "SELECT color_signature FROM images WHERE image_path = (%s)"
+        get_cursor().execute(select_query, (to_db_path(file), ))
+        row = get_cursor().fetchone()
+
+        return bytes(row[0]) if row and row[0] is not None else None
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+
+
+def get_images_by_ids(image_ids):
+    """
+    Получает пути к изображениям по их айди с сохранением порядка айди.
+    Айди изображений, которых уже нет в базе данных, пропускаются.
+    :param image_ids: Список айди изображений.
+    :return: Список путей к изображениям в формате get_images.
+    """
+    try:
+        select_query = "SELECT id, image_path FROM images WHERE id = ANY(%s)"
+        get_cursor().execute(select_query, (list(image_ids), ))
+        paths = dict(get_cursor().fetchall())
+
+        return [(paths[image_id], ) for image_id in image_ids if image_id in paths]
+
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")